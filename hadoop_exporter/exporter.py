@@ -1,10 +1,17 @@
 import os
 from re import S
+import sched
 import time
+import threading
 import traceback
-from typing import Callable, Dict, List, Optional
-from prometheus_client.core import REGISTRY
-from prometheus_client import start_http_server
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
+from urllib.parse import parse_qs, urlparse
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import REGISTRY, Metric
+from prometheus_client.exposition import choose_encoder
 import yaml
 from hadoop_exporter import utils
 from hadoop_exporter.common import MetricCollector
@@ -28,6 +35,8 @@ EXPORTER_PORT_DEFAULT = 9130
 EXPORTER_PATH_DEFAULT = '/metrics'
 EXPORTER_PERIOD_DEFAULT=30
 
+_register_lock = threading.Lock()
+
 
 class ExporterEnv:
     EXPORTER_CONFIG = os.environ.get('EXPORTER_CONFIG', None)
@@ -57,26 +66,116 @@ class ExporterEnv:
 
 
 class Service:
+    collector: Callable
+    url: str
+    cluster: str
+    name: Optional[str]
+    registry: CollectorRegistry
+    _registered: threading.Event
+
     def __init__(self, cluster: str, url: str, collector: Callable = MetricCollector, name: Optional[str] = None) -> None:
         self.collector = collector
         self.url = url
         self.cluster = cluster
-        self.flag = True
         self.name = name
+        self.registry = CollectorRegistry()
+        self._registered = threading.Event()
+
+    def register(self) -> None:
+        if self._registered.is_set():
+            return
+        with _register_lock:
+            if not self._registered.is_set():
+                logger.info("register new {} listen from {}".format(
+                    self.collector.__name__, self.url))
+                self.registry.register(self.collector(
+                    cluster=self.cluster, url=self.url))
+                self._registered.set()
 
-    def register(self):
-        if self.flag:
-            logger.info("register new {} listen from {}".format(
-                self.collector.__name__, self.url))
-            REGISTRY.register(self.collector(
-                cluster=self.cluster, url=self.url))
-            self.flag = not self.flag
+    def match(self, keys: Iterable[str]) -> bool:
+        '''
+        check if the service is selected by any key, a key is the service name, or its collector service or component.
+        '''
+        collector_keys = {self.name, getattr(self.collector, 'SERVICE', None),
+                          getattr(self.collector, 'COMPONENT', None)}
+        return any(key in collector_keys for key in keys)
 
     def __str__(self) -> str:
         return "(cluster: {}, url: {}, collector: {}{})".format(
             self.cluster, self.url, self.collector.__name__, f', name: {self.name}' if self.name else '')
 
 
+class MergedRegistry:
+    '''
+    A read-only view over several registries, merging samples of same-named metric families,
+    so services with the same collector type are exposed as one family.
+    Duplicated services are rejected at startup, as a safety net samples with the same name and labels
+    as an earlier one are still dropped, an exposition can not repeat a series.
+    '''
+
+    def __init__(self, registries: Iterable) -> None:
+        self.registries = list(registries)
+
+    def collect(self):
+        families: Dict[str, Metric] = {}
+        seen = set()
+        duplicated = []
+        for registry in self.registries:
+            for family in registry.collect():
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = Metric(family.name, family.documentation, family.type, family.unit)
+                    families[family.name] = merged
+                for sample in family.samples:
+                    key = (sample.name, tuple(sorted(sample.labels.items())))
+                    if key in seen:
+                        duplicated.append(key)
+                        continue
+                    seen.add(key)
+                    merged.samples.append(sample)
+        if duplicated and utils.should_log_error('duplicated samples'):
+            name, labels = duplicated[0]
+            logger.warning(
+                "dropped %s duplicated samples, e.g. %s%s, services of the same type need distinct cluster names",
+                len(duplicated), name, dict(labels))
+        return iter(families.values())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serve metrics of all services, or of the services picked by the "service" query param,
+    e.g. /metrics?service=namenode,datanode
+    '''
+    # set by the subclass built in Exporter.register_consul
+    exporter: 'Exporter'
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != self.exporter.path.rstrip('/'):
+            self.send_error(404)
+            return
+        keys = [key for value in parse_qs(url.query).get('service', [])
+                for key in value.split(',') if key]
+        encoder, content_type = choose_encoder(self.headers.get('Accept'))
+        try:
+            # one scrape context per request, collectors sharing a jmx url fetch it once
+            with utils.ScrapeContext() as context:
+                self.exporter.prefetch(context, keys)
+                output = encoder(MergedRegistry(self.exporter.select_registries(keys)))
+        except Exception:
+            logger.exception("error generating metric output")
+            self.send_error(500, 'error generating metric output')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args) -> None:
+        return
+
+
 class Exporter:
     COLLECTOR_MAPPING = {
         'hdfs': {
@@ -97,18 +196,62 @@ class Exporter:
             'regionserver': HBaseRegionServerMetricCollector
         }
     }
+    # read-only (component, service) -> collector view of COLLECTOR_MAPPING
+    _FLAT_MAPPING = MappingProxyType({
+        (component, service): collector
+        for component, services in COLLECTOR_MAPPING.items()
+        for service, collector in services.items()
+    })
+
+    # (whitelist key, arg name, env name, auto discovery url, collector) of each commandline service
+    _AUTO_SPECS = (
+        ('nn', 'namenode_jmx', 'EXPORTER_NAMENODE_JMX',
+         'http://localhost:9870/jmx', HDFSNameNodeMetricCollector),
+        ('dn', 'datanode_jmx', 'EXPORTER_DATANODE_JMX',
+         'http://localhost:9864/jmx', HDFSDataNodeMetricCollector),
+        ('jn', 'journalnode_jmx', 'EXPORTER_JOURNALNODE_JMX',
+         'http://localhost:8480/jmx', HDFSJournalNodeMetricCollector),
+        ('rm', 'resourcemanager_jmx', 'EXPORTER_RESOURCEMANAGER_JMX',
+         'http://localhost:8088/jmx', YARNResourceManagerMetricCollector),
+        ('nm', 'nodemanager_jmx', 'EXPORTER_NODEMANAGER_JMX',
+         'http://localhost:8042/jmx', YARNNodeManagerMetricCollector),
+        ('mrjh', 'mapred_jobhistory_jmx', 'EXPORTER_MAPRED_JOBHISTORY_JMX',
+         'http://localhost:19888/jmx', MapredJobHistoryMetricCollector),
+        ('hs2', 'hiveserver2_jmx', 'EXPORTER_HIVESERVER2_JMX',
+         'http://localhost:10002/jmx', HiveServer2MetricCollector),
+        ('hllap', 'hivellap_jmx', 'EXPORTER_HIVELLAP_JMX',
+         'http://localhost:15002/jmx', HiveLlapDaemonMetricCollector),
+        ('hm', 'hmaster_jmx', 'EXPORTER_HMASTER_JMX',
+         'http://localhost:16010/jmx', HBaseMasterMetricCollector),
+        ('hr', 'hregion_jmx', 'EXPORTER_HREGION_JMX',
+         'http://localhost:16030/jmx', HBaseRegionServerMetricCollector),
+    )
+
+    config: Optional[str]
+    address: str
+    port: int
+    path: str
+    period: int
+    auto_discovery: bool
+    discovery_whitelist: Optional[str]
+    _whitelist: Optional[FrozenSet[str]]
+    sevices: List[Service]
+    _executor: ThreadPoolExecutor
+    _scheduler: sched.scheduler
 
     def __init__(self) -> None:
         args = utils.parse_args()
         self.config = args.config or ExporterEnv.EXPORTER_CONFIG
         self.auto_discovery = False
-        self.discovery_whitelist = []
+        self.discovery_whitelist = None
+        self._whitelist = None
+        self.sevices = []
 
         if self.config:
             logger.info("use provided config: {}".format(self.config))
             try:
                 with open(self.config, 'r') as f:
-                    cfg = yaml.safe_load(f)
+                    cfg = yaml.load(f, Loader=utils.SafeLoader)
             except:
                 logger.error("something wrong when load config file")
                 traceback.print_exc()
@@ -118,129 +261,166 @@ class Exporter:
                 self.port = int(server.get('port', EXPORTER_PORT_DEFAULT))
                 self.path = server.get('path', ExporterEnv.EXPORTER_PATH)
                 self.period = int(server.get('period', ExporterEnv.EXPORTER_PERIOD))
-                self.sevices: List[Service] = []
 
                 jmx = cfg.get('jmx', [])
                 for js in jmx:
                     try:
                         service = self._parse_service(js)
                         self.sevices.append(service)
-                    except:
-                        logger.warning(f'error when parse jmx_service: {js}')
-                        traceback.print_exc()
+                    except (TypeError, ValueError) as e:
+                        logger.warning(f'error when parse jmx_service: {js}, {e}')
         else:
             self.address = args.address or ExporterEnv.EXPORTER_ADDRESS
             self.port = int(args.port or ExporterEnv.EXPORTER_PORT)
             self.path = args.path or ExporterEnv.EXPORTER_PATH
             self.period = int(args.period or ExporterEnv.EXPORTER_PERIOD)
-            self.sevices: List[Service] = []
 
             if (args.auto_discovery or ExporterEnv.EXPORTER_AUTO_DISCOVERY).lower() == 'true':
                 self.auto_discovery = True
 
             self.discovery_whitelist = args.discovery_whitelist or ExporterEnv.EXPORTER_DISCOVERY_WHITELIST
 
-            cluster_name = args.cluster_name or ExporterEnv.EXPORTER_CLUSTER_NAME
-            namenode_jmx = args.namenode_jmx or ExporterEnv.EXPORTER_NAMENODE_JMX
-            datanode_jmx = args.datanode_jmx or ExporterEnv.EXPORTER_DATANODE_JMX
-            journalnode_jmx = args.journalnode_jmx or ExporterEnv.EXPORTER_JOURNALNODE_JMX
-            resourcemanager_jmx = args.resourcemanager_jmx or ExporterEnv.EXPORTER_RESOURCEMANAGER_JMX
-            nodemanager_jmx = args.nodemanager_jmx or ExporterEnv.EXPORTER_NODEMANAGER_JMX
-            mapred_jobhistory_jmx = args.mapred_jobhistory_jmx or ExporterEnv.EXPORTER_MAPRED_JOBHISTORY_JMX
-            hmaster_jmx = args.hmaster_jmx or ExporterEnv.EXPORTER_HMASTER_JMX
-            hregion_jmx = args.hregion_jmx or ExporterEnv.EXPORTER_HREGION_JMX
-            hiveserver2_jmx = args.hiveserver2_jmx or ExporterEnv.EXPORTER_HIVESERVER2_JMX
-            hivellap_jmx = args.hivellap_jmx or ExporterEnv.EXPORTER_HIVELLAP_JMX
+            self._whitelist = frozenset(self.discovery_whitelist.split(',')) \
+                if self.discovery_whitelist is not None else None
 
-            if self.auto_discovery:
-                namenode_jmx = namenode_jmx or 'http://localhost:9870/jmx'
-                datanode_jmx = datanode_jmx or 'http://localhost:9864/jmx'
-                journalnode_jmx = journalnode_jmx or 'http://localhost:8480/jmx'
-                resourcemanager_jmx = resourcemanager_jmx or 'http://localhost:8088/jmx'
-                nodemanager_jmx = nodemanager_jmx or 'http://localhost:8042/jmx'
-                mapred_jobhistory_jmx = mapred_jobhistory_jmx or 'http://localhost:19888/jmx'
-                hmaster_jmx = hmaster_jmx or 'http://localhost:16010/jmx'
-                hregion_jmx = hregion_jmx or 'http://localhost:16030/jmx'
-                hiveserver2_jmx = hiveserver2_jmx or 'http://localhost:10002/jmx'
-                hivellap_jmx = hivellap_jmx or 'http://localhost:15002/jmx'
+            cluster_name = args.cluster_name or ExporterEnv.EXPORTER_CLUSTER_NAME
 
             if self.auto_discovery:
                 logger.info("enable service auto discovery mode")
 
-            if namenode_jmx and self._check_whitelist('nn'):
-                self.sevices.append(self._make_service(
-                    cluster_name, namenode_jmx, HDFSNameNodeMetricCollector))
-            if datanode_jmx and self._check_whitelist('dn'):
-                self.sevices.append(self._make_service(
-                    cluster_name, datanode_jmx, HDFSDataNodeMetricCollector))
-            if journalnode_jmx and self._check_whitelist('jn'):
-                self.sevices.append(self._make_service(
-                    cluster_name, journalnode_jmx, HDFSJournalNodeMetricCollector))
-            if resourcemanager_jmx and self._check_whitelist('rm'):
-                self.sevices.append(self._make_service(
-                    cluster_name, resourcemanager_jmx, YARNResourceManagerMetricCollector))
-            if nodemanager_jmx and self._check_whitelist('nm'):
-                self.sevices.append(self._make_service(
-                    cluster_name, nodemanager_jmx, YARNNodeManagerMetricCollector))
-            if mapred_jobhistory_jmx and self._check_whitelist('mrjh'):
-                self.sevices.append(self._make_service(
-                    cluster_name, mapred_jobhistory_jmx, MapredJobHistoryMetricCollector))
-            if hiveserver2_jmx and self._check_whitelist('hs2'):
-                self.sevices.append(self._make_service(
-                    cluster_name, hiveserver2_jmx, HiveServer2MetricCollector))
-            if hivellap_jmx and self._check_whitelist('hllap'):
-                self.sevices.append(self._make_service(
-                    cluster_name, hivellap_jmx, HiveLlapDaemonMetricCollector))
-            if hmaster_jmx and self._check_whitelist('hm'):
-                self.sevices.append(self._make_service(
-                    cluster_name, hmaster_jmx, HBaseMasterMetricCollector))
-            if hregion_jmx and self._check_whitelist('hr'):
-                self.sevices.append(self._make_service(
-                    cluster_name, hregion_jmx, HBaseRegionServerMetricCollector))
+            for key, arg_name, env_name, default_url, collector in self._AUTO_SPECS:
+                url = getattr(args, arg_name) or getattr(ExporterEnv, env_name)
+                if self.auto_discovery:
+                    url = url or default_url
+                if url and self._check_whitelist(key):
+                    self.sevices.append(self._make_service(
+                        cluster_name, url, collector, name=key))
+
+        self.sevices = self._drop_duplicated_services(self.sevices)
+
+        # scrape workers and /metrics prefetches share the pool, leave room for both
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, min(32, 2 * len(self.sevices))))
+        self._scheduler = sched.scheduler(time.monotonic, time.sleep)
 
     def _parse_service(self, js: Dict) -> Service:
+        try:
+            collector = self._FLAT_MAPPING[(js['component'], js['service'])]
+        except KeyError:
+            raise ValueError("unsupported component/service: {}/{}".format(
+                js.get('component'), js.get('service')))
+        if 'url' not in js:
+            raise ValueError("missing url")
         service = Service(
             cluster=js.get('cluster', EXPORTER_CLUSTER_NAME_DEFAULT),
             url=js['url'],
-            collector=self.COLLECTOR_MAPPING[js['component']][js['service']],
+            collector=collector,
             name=js.get('name', None)
         )
         logger.info("added service: {}".format(service))
         return service
 
-    def _make_service(self, cluster_name: str, url: str, collector: Callable) -> Service:
+    def _make_service(self, cluster_name: str, url: str, collector: Callable, name: Optional[str] = None) -> Service:
         service = Service(
             cluster=cluster_name,
             url=url,
             collector=collector,
+            name=name,
         )
         logger.info("added service: {}".format(service))
         return service
 
-    def _check_whitelist(self, service) -> bool:
-        if self.discovery_whitelist is None:
-            return True
-        else:
-            whilelist = self.discovery_whitelist.split(',')
-            if service in whilelist:
-                return True
-            else:
-                return False
+    def _drop_duplicated_services(self, services: List[Service]) -> List[Service]:
+        '''
+        keep the first of services sharing a collector and cluster, their series have the same name and labels
+        and could not be told apart in one exposition.
+        '''
+        kept: Dict[tuple, Service] = {}
+        for service in services:
+            key = (service.collector, service.cluster)
+            if key in kept:
+                logger.warning("skip service {}: same collector and cluster as {}, give them distinct cluster names".format(
+                    service, kept[key]))
+                continue
+            kept[key] = service
+        return list(kept.values())
+
+    def _check_whitelist(self, service: str) -> bool:
+        return self._whitelist is None or service in self._whitelist
+
+    def select_services(self, keys: List[str]) -> List[Service]:
+        if not keys:
+            return list(self.sevices)
+        return [service for service in self.sevices if service.match(keys)]
 
-    def register_consul(self):
-        start_http_server(self.port, addr=self.address)
+    def select_registries(self, keys: List[str]) -> List[CollectorRegistry]:
+        registries = [service.registry for service in self.select_services(keys)]
+        return registries if keys else [REGISTRY] + registries
+
+    def prefetch(self, context: utils.ScrapeContext, keys: List[str]) -> None:
+        '''
+        fetch the jmx urls of the selected services concurrently into the scrape context,
+        urls refreshed by the scrape workers are served from cache without a request.
+        '''
+        context.prefetch([service.url.rstrip('/') for service in self.select_services(keys)],
+                         self._executor)
+
+    def register_consul(self) -> None:
+        handler = type('ExporterMetricsHandler', (MetricsHandler,), {'exporter': self})
+        httpd = ThreadingHTTPServer((self.address, self.port), handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
         logger.info(
-            f"exporter start listening on http://{self.address}:{self.port}")
+            f"exporter start listening on http://{self.address}:{self.port}{self.path}")
+
+    def _scrape_service(self, service: Service, busy: threading.Event) -> None:
+        try:
+            service.register()
+            # renew the jmx cache, so /metrics is served the beans of this round without waiting on jmx
+            utils.refresh_metrics(service.url.rstrip('/'))
+        except Exception as e:
+            self._log_scrape_error(service, e)
+        finally:
+            busy.clear()
+
+    def _log_scrape_error(self, service: Service, error: Exception) -> None:
+        '''
+        log the error with its traceback, at most once each utils.EXPORTER_ERROR_LOG_INTERVAL seconds
+        for the same service and exception type.
+        '''
+        if utils.should_log_error((service, type(error).__name__)):
+            logger.exception("error when scrape service: %s", service)
+
+    def _schedule_service(self, service: Service, busy: threading.Event) -> None:
+        if busy.is_set():
+            logger.warning(
+                f"previous scrape of {service} is still running, skip this round")
+        else:
+            busy.set()
+            self._executor.submit(self._scrape_service, service, busy)
+        self._scheduler.enter(
+            self.period, 1, self._schedule_service, (service, busy))
+
+    def _idle(self) -> None:
+        self._scheduler.enter(self.period, 1, self._idle)
 
-    def register_prometheus(self):
+    def register_prometheus(self) -> None:
+        # keep the beans of a worker until the next worker round has finished, so /metrics never waits on jmx
+        utils.set_jmx_cache_ttl(self.period + 2 * utils.JMX_TIMEOUT)
+        for service in self.sevices:
+            self._scheduler.enter(
+                0, 1, self._schedule_service, (service, threading.Event()))
+        if not self.sevices:
+            # nothing to scrape, keep the scheduler alive so the http server keeps serving
+            logger.warning("no jmx service to scrape, only serve the default metrics")
+            self._scheduler.enter(self.period, 1, self._idle)
+        logger.info(f"scraping metrics each {self.period}s...")
         try:
-            while True:
-                for service in self.sevices:
-                    service.register()
-                logger.info(f"continue scaping metrics each {self.period}s...")
-                time.sleep(self.period)
+            self._scheduler.run()
         except KeyboardInterrupt:
             logger.info("interrupted")
             exit(0)
-        except:
-            traceback.print_exc()
+        except Exception:
+            logger.exception("scrape scheduler failed")
+        finally:
+            self._executor.shutdown(wait=False)
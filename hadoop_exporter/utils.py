@@ -2,13 +2,100 @@
 # -*- coding: utf-8 -*-
 
 import os
+import copy
+import queue
+import atexit
+import functools
 import socket
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
 import yaml
 import argparse
+from collections import OrderedDict
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 EXPORTER_LOGS_DIR = os.environ.get('EXPORTER_LOGS_DIR', '/tmp/exporter')
+EXPORTER_LOG_LEVEL = os.environ.get('EXPORTER_LOG_LEVEL', 'INFO')
+EXPORTER_ENV = os.environ.get('EXPORTER_ENV', None)
+EXPORTER_JMX_CACHE_TTL = os.environ.get('EXPORTER_JMX_CACHE_TTL', None)
+# seconds before the same error is logged again
+EXPORTER_ERROR_LOG_INTERVAL = 300
+
+_PKG_DIR = os.path.dirname(os.path.realpath(__file__))
+_PARENT_DIR = os.path.dirname(_PKG_DIR)
+
+# parsed metric files, keyed by absolute path, valued by (mtime_ns, size) stamp and metrics
+_json_file_cache = OrderedDict()
+_JSON_FILE_CACHE_MAXSIZE = 100
+
+
+# log records are queued by the logging threads and written by a single listener thread
+_log_queue = queue.Queue(-1)
+_log_listener = None
+_log_queue_handlers = {}
+_log_lock = threading.Lock()
+_log_level = logging.getLevelName(EXPORTER_LOG_LEVEL.upper())
+if not isinstance(_log_level, int):
+    _log_level = logging.INFO
+
+
+def _get_queue_handler(log_file):
+    '''
+    create once, then share the queue handler of a log file, so loggers writing to the same file
+    do not open it again nor add duplicated handlers.
+    '''
+    global _log_listener
+    with _log_lock:
+        handler = _log_queue_handlers.get(log_file)
+        if handler is not None:
+            return handler
+
+        if not os.path.exists(EXPORTER_LOGS_DIR):
+            os.makedirs(EXPORTER_LOGS_DIR)
+
+        fmt = logging.Formatter(
+            fmt='%(asctime)s %(filename)s[line:%(lineno)d]-[%(levelname)s]: %(message)s')
+
+        # records are tagged with their log file by the queue handler, the file handler only keeps its own
+        fh = logging.FileHandler(os.path.join(EXPORTER_LOGS_DIR, log_file))
+        fh.setLevel(_log_level)
+        fh.setFormatter(fmt)
+        fh.addFilter(lambda record: getattr(record, 'log_file', None) == log_file)
+
+        if _log_listener is None:
+            sh = logging.StreamHandler()
+            sh.setLevel(_log_level)
+            sh.setFormatter(fmt)
+            _log_listener = logging.handlers.QueueListener(
+                _log_queue, sh, fh, respect_handler_level=True)
+            _log_listener.start()
+            atexit.register(_log_listener.stop)
+        else:
+            _log_listener.handlers = _log_listener.handlers + (fh,)
+
+        def tag(record):
+            record.log_file = log_file
+            return True
+
+        handler = logging.handlers.QueueHandler(_log_queue)
+        handler.setLevel(_log_level)
+        handler.addFilter(tag)
+        _log_queue_handlers[log_file] = handler
+        return handler
 
 
 def get_logger(name, log_file="hadoop_exporter.log"):
@@ -21,26 +108,127 @@ def get_logger(name, log_file="hadoop_exporter.log"):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
 
-    if not os.path.exists(EXPORTER_LOGS_DIR):
-        os.makedirs(EXPORTER_LOGS_DIR)
+    handler = _get_queue_handler(log_file)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    return logger
+
 
-    fh = logging.FileHandler(os.path.join(EXPORTER_LOGS_DIR, log_file))
-    fh.setLevel(logging.INFO)
+logger = get_logger(__name__)
 
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
+# last time each error was logged, keyed by error key
+_error_log_times = {}
+_error_log_lock = threading.Lock()
 
-    fmt = logging.Formatter(
-        fmt='%(asctime)s %(filename)s[line:%(lineno)d]-[%(levelname)s]: %(message)s')
-    fh.setFormatter(fmt)
-    sh.setFormatter(fmt)
 
-    logger.addHandler(fh)
-    logger.addHandler(sh)
-    return logger
+def should_log_error(key):
+    '''
+    check if the error identified by key should be logged, each error is logged at most once
+    every EXPORTER_ERROR_LOG_INTERVAL seconds, so a flapping service does not flood the log.
+    @param key: A hashable from a bounded set, e.g. (url, exception type name).
+    @return True if the error was not logged in the interval.
+    '''
+    now = time.monotonic()
+    with _error_log_lock:
+        last = _error_log_times.get(key)
+        if last is not None and now - last < EXPORTER_ERROR_LOG_INTERVAL:
+            return False
+        _error_log_times[key] = now
+        return True
 
 
-logger = get_logger(__name__)
+def _make_session():
+    '''
+    build a pooled requests session, so jmx connections are kept alive across scrapes.
+    only failed connections are retried, a hung endpoint still gives up after JMX_TIMEOUT seconds.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32, pool_maxsize=32,
+        max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_SESSION = _make_session()
+
+# (connect, read) timeouts in seconds of a jmx request
+JMX_CONNECT_TIMEOUT = 1
+JMX_TIMEOUT = 5
+
+# beans fetched from jmx, keyed by url, valued by (expires_at, beans)
+_beans_cache = {}
+_beans_cache_lock = threading.Lock()
+_beans_cache_ttl = float(EXPORTER_JMX_CACHE_TTL) if EXPORTER_JMX_CACHE_TTL else 15.0
+
+
+def set_jmx_cache_ttl(ttl):
+    '''
+    set how long (seconds) the beans of a jmx url are served from cache, 0 disables the cache.
+    an explicit EXPORTER_JMX_CACHE_TTL always wins.
+    '''
+    global _beans_cache_ttl
+    if not EXPORTER_JMX_CACHE_TTL:
+        _beans_cache_ttl = float(ttl)
+
+
+def _get_cached_beans(url):
+    with _beans_cache_lock:
+        cached = _beans_cache.get(url)
+    if cached is not None and cached[0] > time.monotonic():
+        logger.debug("jmx cache hit: %s", url)
+        return cached[1]
+    logger.debug("jmx cache miss: %s", url)
+    return None
+
+
+def _set_cached_beans(url, beans):
+    if _beans_cache_ttl <= 0:
+        return
+    with _beans_cache_lock:
+        _beans_cache[url] = (time.monotonic() + _beans_cache_ttl, beans)
+
+
+# the ScrapeContext entered by the current thread, if any
+_scrape_context = threading.local()
+
+
+class ScrapeContext(object):
+    '''
+    ScrapeContext memoizes the beans of each jmx url for the duration of one scrape,
+    so all collectors reading the same url in the scrape share a single request.
+
+    with ScrapeContext():
+        ... collectors call get_metrics(url) ...
+    '''
+
+    def __init__(self):
+        self._beans = {}
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_scrape_context, 'current', None)
+        _scrape_context.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _scrape_context.current = self._previous
+        self._previous = None
+        return False
+
+    def prefetch(self, urls, executor):
+        '''
+        fetch the jmx urls not yet in this scrape concurrently on executor,
+        so the scrape waits for the slowest url instead of the sum of all of them.
+        '''
+        self._beans.update(scrape_all(
+            [url for url in urls if url not in self._beans], executor))
+
+    def get_metrics(self, url):
+        if url not in self._beans:
+            self._beans[url] = _request_metrics(url)
+        return self._beans[url]
 
 
 def get_metrics(url):
@@ -48,30 +236,60 @@ def get_metrics(url):
     :param url: The jmx url, e.g. http://host1:9870/jmx,http://host1:8088/jmx, http://host2:19888/jmx...
     :return a dict of all metrics scraped in the jmx url.
     '''
-    result = []
+    context = getattr(_scrape_context, 'current', None)
+    if context is not None:
+        return context.get_metrics(url)
+    return _request_metrics(url)
+
+
+def refresh_metrics(url):
+    '''
+    request the jmx url bypassing the cache, and overwrite its cache entry on success.
+    used by the scrape workers, so the cache is renewed every period.
+    '''
+    return _request_metrics(url, refresh=True)
+
+
+def _request_metrics(url, refresh=False):
+    if not refresh:
+        cached = _get_cached_beans(url)
+        if cached is not None:
+            return cached
     try:
-        s = requests.session()
-        response = s.get(url, timeout=5)
-    except Exception as e:
-        logger.warning("error in func: get_metrics, error msg: %s" % e)
-        result = []
-    else:
+        response = _SESSION.get(url, timeout=(JMX_CONNECT_TIMEOUT, JMX_TIMEOUT))
         if response.status_code != requests.codes.ok:
-            logger.warning("get {0} failed, response code is: {1}.".format(
-                url, response.status_code))
-            result = []
-        rlt = response.json()
-        logger.debug(rlt)
-        if rlt and "beans" in rlt:
-            result = rlt['beans']
-        else:
-            logger.warning("no metrics get in the {0}.".format(url))
-            result = []
-    finally:
-        s.close()
-    return result
+            if should_log_error((url, response.status_code)):
+                logger.warning("get %s failed, response code is: %s.",
+                               url, response.status_code)
+            return []
+        rlt = orjson.loads(response.content) if orjson else response.json()
+    except (requests.RequestException, ValueError) as e:
+        if should_log_error((url, type(e).__name__)):
+            logger.warning("error in func: get_metrics, error msg: %s", e)
+        return []
+    if rlt and "beans" in rlt:
+        logger.debug("got %s beans from %s", len(rlt['beans']), url)
+        _set_cached_beans(url, rlt['beans'])
+        return rlt['beans']
+    if should_log_error((url, 'no beans')):
+        logger.warning("no metrics get in the %s.", url)
+    return []
 
 
+def scrape_all(urls, executor):
+    '''
+    scrape jmx urls concurrently on executor over the pooled session, so the wall time is
+    the slowest url's instead of the sum of all of them, each url is bounded by JMX_TIMEOUT.
+    @param urls: A list of jmx urls.
+    @param executor: A concurrent.futures executor running the requests.
+    @return a dict of beans keyed by url.
+    '''
+    futures = [(url, executor.submit(_request_metrics, url))
+               for url in dict.fromkeys(urls)]
+    return {url: future.result() for url, future in futures}
+
+
+@functools.lru_cache(maxsize=1)
 def get_host_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -82,6 +300,7 @@ def get_host_ip():
     return ip
 
 
+@functools.lru_cache(maxsize=1)
 def get_hostname():
     '''
     get hostname via socket.
@@ -100,17 +319,31 @@ def read_json_file(path_name, file_name):
     '''
     read metric json files.
     '''
-    path = os.path.dirname(os.path.realpath(__file__))
-    parent_path = os.path.dirname(path)
-    metric_path = os.path.join(parent_path, path_name)
+    metric_path = os.path.join(_PARENT_DIR, path_name)
     metric_name = "{0}.json".format(file_name)
+    metric_file = os.path.join(metric_path, metric_name)
     try:
-        with open(os.path.join(metric_path, metric_name), 'r') as f:
-            metrics = yaml.safe_load(f)
-            return metrics
+        # in production the metric files never change, so skip stat and keep them until restart
+        if EXPORTER_ENV == 'production':
+            stamp = None
+        else:
+            st = os.stat(metric_file)
+            stamp = (st.st_mtime_ns, st.st_size)
+        cached = _json_file_cache.get(metric_file)
+        if cached is not None and cached[0] == stamp:
+            _json_file_cache.move_to_end(metric_file)
+            return copy.deepcopy(cached[1])
+        with open(metric_file, 'r') as f:
+            metrics = yaml.load(f, Loader=SafeLoader)
     except Exception as e:
         logger.info("read metrics json file failed, error msg is: %s" % e)
         return {}
+    else:
+        _json_file_cache[metric_file] = (stamp, metrics)
+        _json_file_cache.move_to_end(metric_file)
+        if len(_json_file_cache) > _JSON_FILE_CACHE_MAXSIZE:
+            _json_file_cache.popitem(last=False)
+        return copy.deepcopy(metrics)
 
 
 def get_file_list(file_path_name):
@@ -119,19 +352,13 @@ def get_file_list(file_path_name):
     @param file_path: The file path name, e.g. namenode, ugi, resourcemanager ...
     @return a list of file name.
     '''
-    path = os.path.dirname(os.path.abspath(__file__))
-    parent_path = os.path.dirname(path)
-    json_path = os.path.join(parent_path, file_path_name)
+    json_path = os.path.join(_PARENT_DIR, file_path_name)
     try:
-        files = os.listdir(json_path)
+        with os.scandir(json_path) as it:
+            return [e.name[:-5] for e in it if e.name.endswith('.json') and e.is_file()]
     except OSError:
         logger.info("no such file or directory: '%s'" % json_path)
         return []
-    else:
-        rlt = []
-        for i in range(len(files)):
-            rlt.append(files[i].split(".json")[0])
-        return rlt
 
 
 def get_node_info(url):
@@ -145,8 +372,7 @@ def get_node_info(url):
     host = get_hostname()
     node_info = {}
     try:
-        s = requests.session()
-        response = s.get(url, timeout=120)
+        response = _SESSION.get(url, timeout=120)
     except Exception as e:
         logger.info(
             "error happened while requests url {0}, error msg : {1}".format(url, e))
@@ -169,11 +395,10 @@ def get_node_info(url):
         else:
             logger.info("No metrics get in the {0}.".format(url))
             node_info = {}
-    finally:
-        s.close()
     return node_info
 
 
+@functools.lru_cache(maxsize=1)
 def parse_args():
 
     parser = argparse.ArgumentParser(